@@ -0,0 +1,226 @@
+"""Run benchmarks for source detection functions."""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import time
+import os
+import glob
+import argparse
+from collections import OrderedDict
+import numpy as np
+import photutils
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("-l", "--label", dest="label", default=None,
+                    help="Save results to a pickle with this label, so that"
+                    "they can be displayed later. Pickles are save in a "
+                    "'_results' directory in the same parent directory as "
+                    "this script.")
+parser.add_argument("-s", "--show", dest="show", action="store_true",
+                    default=False, help="Show all results from previously "
+                    "labeled runs")
+parser.add_argument("-d", "--delete", dest="delete_label", default=None,
+                    help="Delete saved results with the given label "
+                    "(or 'all' to delete all results). Do not run any "
+                    "benchmarks.")
+args = parser.parse_args()
+
+if args.show and args.label:
+    parser.error("--label doesn't do anything when --show is specified.")
+if args.delete_label and (args.label or args.show):
+    parser.error("--label and --show do not do anything when --delete is "
+                 "specified.")
+
+resultsdir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                          '_results', 'detection'))
+piknames = glob.glob(os.path.join(resultsdir, '*.pik'))
+
+# Delete saved results, if requested.
+if args.delete_label is not None:
+    if args.delete_label.lower() == 'all':
+        for pikname in piknames:
+            os.remove(pikname)
+    else:
+        try:
+            os.remove(os.path.join(resultsdir,
+                                   '{0}.pik'.format(args.delete_label)))
+        except OSError:
+            raise ValueError('No such label exists: {0}'
+                             .format(args.delete_label))
+    exit()
+
+c = OrderedDict()
+
+# Pure noise thresholded at 1 sigma gives ~10^4 small sources per
+# 1000x1000 pixels, which stresses the per-source overhead of the
+# size filter and relabeling.
+name = "Big data, many small sources"
+c[name] = {}
+c[name]['dims']        = (1000, 1000)
+c[name]['nstars']      = 0
+c[name]['snr']         = 1.
+c[name]['npixels']     = 5
+c[name]['filter_fwhm'] = None
+c[name]['iter']        = 5
+
+name = "Big data, few sources, filtered"
+c[name] = {}
+c[name]['dims']        = (1000, 1000)
+c[name]['nstars']      = 100
+c[name]['snr']         = 3.
+c[name]['npixels']     = 5
+c[name]['filter_fwhm'] = 2.
+c[name]['iter']        = 5
+
+name = "Big data, few sources, wide filter"
+c[name] = {}
+c[name]['dims']        = (1000, 1000)
+c[name]['nstars']      = 100
+c[name]['snr']         = 3.
+c[name]['npixels']     = 5
+c[name]['filter_fwhm'] = 8.
+c[name]['iter']        = 5
+
+name = "Huge data, many small sources"
+c[name] = {}
+c[name]['dims']        = (4000, 4000)
+c[name]['nstars']      = 0
+c[name]['snr']         = 1.
+c[name]['npixels']     = 5
+c[name]['filter_fwhm'] = None
+c[name]['iter']        = 1
+
+# Select subset of defined tests and engines to run, to save time.
+names_to_run = ["Big data, many small sources",
+                "Big data, few sources, filtered",
+                "Big data, few sources, wide filter",
+                "Huge data, many small sources"]
+
+engines_to_run = ['auto', 'numba', 'sep']
+
+# Python package required by each engine.  detect_sources silently falls
+# back to 'auto' if it is missing, so such engines are not run.
+engine_modules = {'auto': None, 'numba': 'numba', 'sep': 'sep'}
+
+
+def engine_available(engine):
+    """Return whether the package required by ``engine`` is installed."""
+    if engine_modules[engine] is None:
+        return True
+    try:
+        __import__(engine_modules[engine])
+    except ImportError:
+        return False
+    return True
+
+
+def make_data(dims, nstars):
+    """Make a noise image with ``nstars`` Gaussian stars."""
+    prng = np.random.RandomState(12345)
+    data = prng.normal(size=dims)
+    yy, xx = np.mgrid[0:dims[0], 0:dims[1]]
+    for i in range(nstars):
+        x0 = prng.uniform(0, dims[1])
+        y0 = prng.uniform(0, dims[0])
+        data += 20. * np.exp(-((xx - x0)**2 + (yy - y0)**2) / 8.)
+    return data
+
+
+if not args.show:
+
+    # Initialize results
+    results = OrderedDict()
+
+    # print version information
+    print("=" * 79)
+    from astropy import __version__
+    print("astropy version:", __version__)
+    print("photutils version:", photutils.__version__)
+    print("numpy version:", np.__version__)
+    print("=" * 79)
+
+    for name in names_to_run:
+
+        results[name] = OrderedDict()
+        data = make_data(c[name]['dims'], c[name]['nstars'])
+
+        # Print header for this benchmark
+        print("=" * 79)
+        print(name, "  (milliseconds)")
+        print("-" * 79)
+
+        t0 = time.time()
+
+        for engine in engines_to_run:
+            if not engine_available(engine):
+                print("{0:8s} {1:>10s}   ({2} not installed)".format(
+                    engine, '-', engine_modules[engine]))
+                continue
+
+            # run once to exclude any compilation time
+            segm = photutils.detect_sources(
+                data, c[name]['snr'], c[name]['npixels'],
+                filter_fwhm=c[name]['filter_fwhm'], engine=engine)
+
+            time1 = time.time()
+            for i in range(c[name]['iter']):
+                photutils.detect_sources(
+                    data, c[name]['snr'], c[name]['npixels'],
+                    filter_fwhm=c[name]['filter_fwhm'], engine=engine)
+            time2 = time.time()
+            time_sec = (time2 - time1) / c[name]['iter']
+            print("{0:8s} {1:10.3f}   ({2} sources)".format(
+                engine, time_sec * 1000., segm.max()))
+            results[name][engine] = time_sec
+
+        t1 = time.time()
+
+        print("-" * 79)
+        print('Real time: {0:10.4f} s'.format(t1 - t0))
+        print("")
+
+    # If a label was specified, save results to a pickle.
+    if args.label is not None:
+        import pickle
+        pikname = os.path.join(resultsdir, '{0}.pik'.format(args.label))
+        if not os.path.exists(resultsdir):
+            os.makedirs(resultsdir)
+        outfile = open(pikname, 'wb')
+        pickle.dump(results, outfile)
+        outfile.close()
+
+if args.show:
+    import pickle
+
+    # Load pickled results
+    results = OrderedDict()
+    piknames = glob.glob(os.path.join(resultsdir, '*.pik'))
+    for pikname in piknames:
+        label = os.path.basename(pikname)[:-4]
+        infile = open(pikname, 'rb')
+        results[label] = pickle.load(infile)
+        infile.close()
+    if len(results) == 0:
+        raise RuntimeError('No saved results.')
+
+    # Loop over different cases
+    firstlabel = list(results.keys())[0]
+    for name in results[firstlabel]:
+
+        # Print header for this case
+        print("=" * 79)
+        print("{0} (milliseconds)".format(name))
+        print("{0:20s} ".format("label") +
+              " ".join(e.center(10) for e in engines_to_run))
+        print("-" * 79)
+
+        for label, result in results.items():
+            if name not in result:
+                continue
+            print("{0:20s} ".format(label) +
+                  " ".join("{0:10.3f}".format(result[name][e] * 1000.)
+                           if e in result[name] else " " * 10
+                           for e in engines_to_run))
+
+        print("-" * 79)
+        print("")
@@ -0,0 +1,148 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Numba kernels that threshold, label, and size-filter an image in two
+raster scans.  These are used by `~photutils.detection.detect_sources`
+when ``engine='numba'``.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from numba import njit
+
+
+@njit(boundscheck=False)
+def _find_root(parent, i):
+    """Find the root of ``i``, compressing the path along the way."""
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        next_i = parent[i]
+        parent[i] = root
+        i = next_i
+    return root
+
+
+@njit(boundscheck=False)
+def _union(parent, rank, i, j):
+    """Merge the trees containing ``i`` and ``j`` (union by rank)."""
+    i = _find_root(parent, i)
+    j = _find_root(parent, j)
+    if i == j:
+        return
+    if rank[i] < rank[j]:
+        i, j = j, i
+    parent[j] = i
+    if rank[i] == rank[j]:
+        rank[i] += 1
+
+
+@njit(boundscheck=False)
+def _threshold_label(data, level, labels):
+    """
+    Threshold a 2D image and label its 4-connected regions in a single
+    raster scan.
+
+    This is the first pass of the classic two-pass (Rosenfeld)
+    algorithm: each pixel greater than or equal to ``level`` receives a
+    provisional label, and equivalent provisional labels are merged in
+    a union-find forest.  The number of pixels in each region is
+    accumulated during the same scan.
+
+    Parameters
+    ----------
+    data : 2D ndarray
+        The image to threshold.
+
+    level : float
+        The threshold level.
+
+    labels : 2D `~numpy.int32` ndarray
+        The array, with the same shape as ``data``, in which to place
+        the provisional labels.  It does not need to be initialized.
+
+    Returns
+    -------
+    parent : 1D `~numpy.int32` ndarray
+        The root (region) label of each provisional label.
+
+    counts : 1D `~numpy.int64` ndarray
+        The number of pixels in each region, indexed by its root label.
+    """
+
+    ny, nx = data.shape
+    # a new provisional label needs background above and to the left
+    maxlabels = ny * ((nx + 1) // 2) + 1
+    parent = np.zeros(maxlabels, dtype=np.int32)
+    rank = np.zeros(maxlabels, dtype=np.uint8)
+    counts = np.zeros(maxlabels, dtype=np.int64)
+
+    nlabels = 0
+    for y in range(ny):
+        for x in range(nx):
+            if not data[y, x] >= level:
+                labels[y, x] = 0
+                continue
+            up = labels[y - 1, x] if y > 0 else 0
+            left = labels[y, x - 1] if x > 0 else 0
+            if up == 0 and left == 0:
+                nlabels += 1
+                parent[nlabels] = nlabels
+                label = nlabels
+            elif up == 0:
+                label = left
+            else:
+                label = up
+                if left != 0 and left != up:
+                    _union(parent, rank, up, left)
+            labels[y, x] = label
+            counts[label] += 1
+
+    # flatten the forest and accumulate the counts onto the roots
+    for i in range(1, nlabels + 1):
+        root = _find_root(parent, i)
+        if root != i:
+            counts[root] += counts[i]
+
+    return parent[:nlabels + 1], counts[:nlabels + 1]
+
+
+@njit(boundscheck=False)
+def _finalize(labels, parent, counts, npixels):
+    """
+    Remove regions smaller than ``npixels`` and rewrite the provisional
+    labels in place as consecutive final labels.
+
+    The final labels are numbered in the order in which the regions are
+    first encountered in a raster scan, as for `scipy.ndimage.label`.
+
+    Parameters
+    ----------
+    labels, parent, counts
+        The labels array filled by `_threshold_label` and its outputs.
+
+    npixels : int
+        The minimum number of pixels of a region.
+
+    Returns
+    -------
+    labels : 2D `~numpy.int32` ndarray
+        The input ``labels`` array, relabeled.
+    """
+
+    nlabels = len(parent) - 1
+    root_labels = np.zeros(nlabels + 1, dtype=np.int32)
+    relabel = np.zeros(nlabels + 1, dtype=np.int32)
+    nobj = 0
+    for i in range(1, nlabels + 1):
+        root = parent[i]
+        if root_labels[root] == 0 and counts[root] >= npixels:
+            nobj += 1
+            root_labels[root] = nobj
+        relabel[i] = root_labels[root]
+
+    ny, nx = labels.shape
+    for y in range(ny):
+        for x in range(nx):
+            labels[y, x] = relabel[labels[y, x]]
+    return labels
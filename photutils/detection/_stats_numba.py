@@ -0,0 +1,114 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Numba kernels for the sigma-clipped image statistics computed by
+``photutils.detection.core._img_stats_numba``.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from numba import njit, prange
+
+# number of chunks of the partial mean and variance reductions
+_NCHUNKS = 64
+
+
+@njit(parallel=True, boundscheck=False)
+def _mean_var(values):
+    """
+    Compute the mean and (population) variance of a 1D array, or NaN
+    if it is empty.
+
+    The means and sums of squared deviations of contiguous chunks are
+    computed in parallel and then merged with Welford's update (Chan et
+    al.), which is numerically stable for large arrays.
+    """
+
+    n = values.size
+    if n == 0:
+        return np.nan, np.nan
+    nchunks = min(n, _NCHUNKS)
+    chunk_size = (n + nchunks - 1) // nchunks
+    counts = np.zeros(nchunks)
+    means = np.zeros(nchunks)
+    m2s = np.zeros(nchunks)
+    for i in prange(nchunks):
+        start = min(i * chunk_size, n)
+        stop = min(start + chunk_size, n)
+        total = 0.0
+        for j in range(start, stop):
+            total += values[j]
+        mean = total / max(stop - start, 1)
+        m2 = 0.0
+        for j in range(start, stop):
+            delta = values[j] - mean
+            m2 += delta * delta
+        counts[i] = stop - start
+        means[i] = mean
+        m2s[i] = m2
+
+    count = 0.0
+    mean = 0.0
+    m2 = 0.0
+    for i in range(nchunks):
+        if counts[i] == 0:
+            continue
+        delta = means[i] - mean
+        total = count + counts[i]
+        mean += delta * counts[i] / total
+        m2 += m2s[i] + delta * delta * count * counts[i] / total
+        count = total
+    return mean, m2 / count
+
+
+@njit(boundscheck=False)
+def _sigma_clip_stats(values, sig, iters):
+    """
+    Compute the sigma-clipped mean, median, and standard deviation of a
+    1D array.
+
+    Values are iteratively rejected if they deviate from the median by
+    more than ``sig`` standard deviations, as in
+    `astropy.stats.sigma_clip`.
+
+    Parameters
+    ----------
+    values : 1D float64 ndarray
+        The values, which are not modified.
+
+    sig : float
+        The number of standard deviations to use as the clipping limit.
+
+    iters : int
+        The number of clipping iterations, or a negative value to clip
+        until convergence.
+
+    Returns
+    -------
+    mean, median, std : float
+        The statistics of the unclipped values, or NaN if all values
+        are clipped.
+    """
+
+    good = values.copy()
+    ngood = good.size
+    niter = 0
+    while ngood > 0 and (iters < 0 or niter < iters):
+        median = np.median(good[:ngood])
+        mean, var = _mean_var(good[:ngood])
+        limit = var * sig ** 2
+        nkeep = 0
+        for i in range(ngood):
+            delta = good[i] - median
+            if delta * delta <= limit:
+                good[nkeep] = good[i]
+                nkeep += 1
+        niter += 1
+        if nkeep == ngood:
+            break
+        ngood = nkeep
+
+    if ngood == 0:
+        return np.nan, np.nan, np.nan
+    good = good[:ngood]
+    mean, var = _mean_var(good)
+    return mean, np.median(good), np.sqrt(var)
@@ -4,11 +4,17 @@ from __future__ import (absolute_import, division, print_function,
 import numpy as np
 from imageutils import img_stats
 
-__all__ = ['detect_sources', 'find_peaks']
+__all__ = ['DetectionWorkspace', 'detect_sources', 'find_peaks']
+
+# 4-connectivity structuring element, created on first use by
+# _get_struct() to avoid importing scipy at module level
+_STRUCT_2_1 = None
 
 
 def detect_sources(data, snr_threshold, npixels, filter_fwhm=None,
-                   mask=None, mask_val=None, sig=3.0, iters=None):
+                   mask=None, mask_val=None, sig=3.0, iters=None,
+                   filter_method='auto', engine='auto', dtype=np.float32,
+                   n_jobs=None, workspace=None, bkgrd_stats_func=None):
     """
     Detect sources above a specified signal-to-noise ratio
     in a 2D image and return a 2D segmentation image.
@@ -38,7 +44,9 @@ def detect_sources(data, snr_threshold, npixels, filter_fwhm=None,
         the input image before it is thresholded.  Filtering the image
         will maximize detectability of objects with a FWHM similar to
         ``filter_fwhm``.  Set to `None` (the default) to turn off image
-        filtering.
+        filtering.  Filtering is also skipped for ``filter_fwhm <
+        0.125``, for which the truncated Gaussian kernel is a single
+        pixel.
 
     mask : array_like, bool, optional
         A boolean mask with the same shape as ``image``, where a `True`
@@ -62,49 +70,463 @@ def detect_sources(data, snr_threshold, npixels, filter_fwhm=None,
        iteration clips nothing) when calculating the image background
        statistics.
 
+    filter_method : {'auto', 'direct', 'fft'}, optional
+        The method used to apply the Gaussian filter.  ``'direct'``
+        convolves the image with the separable Gaussian kernel, whose
+        cost grows linearly with ``filter_fwhm``.  ``'fft'`` performs
+        the convolution using FFTs, whose cost is independent of
+        ``filter_fwhm``.  ``'auto'`` (the default) uses ``'fft'`` when
+        ``filter_fwhm`` is larger than 4 pixels and ``'direct'``
+        otherwise.  Ignored if ``filter_fwhm`` is `None`.
+
+    engine : {'auto', 'numba', 'sep'}, optional
+        The engine used to threshold and label the image.  ``'auto'``
+        (the default) labels the thresholded image with `cc3d
+        <https://github.com/seung-lab/connected-components-3d>`_ if it
+        is installed, otherwise with `scipy.ndimage.label`.
+        ``'numba'`` uses `Numba <http://numba.pydata.org/>`_-compiled
+        kernels that threshold, label, and count the source pixels in
+        a single pass over the image, falling back to ``'auto'`` if
+        Numba is not installed.  ``'sep'`` filters, thresholds, and
+        labels the image in C with `sep
+        <https://sep.readthedocs.io/>`_ (falling back to ``'auto'`` if
+        it is not installed); the ``filter_method`` and ``n_jobs``
+        keywords are ignored and the filtered image may differ
+        slightly from the other engines within ``filter_fwhm`` of the
+        image edges.  ``'sep'`` is usually slower than ``'auto'``
+        because `sep` also measures every source.
+
+    dtype : data-type or `None`, optional
+        The data type to which the image is converted before it is
+        filtered and thresholded.  The default (`~numpy.float32`)
+        halves the memory traffic of those steps for ``float64``
+        images.  Set to `None` to keep the data type of the input
+        image.
+
+    n_jobs : int or `None`, optional
+        The number of threads used to apply the ``'direct'`` Gaussian
+        filter, which splits the image into horizontal strips.  ``-1``
+        uses all CPUs.  Requires `joblib
+        <https://pythonhosted.org/joblib/>`_; if it is not installed,
+        or ``n_jobs`` is `None` (the default) or 1, the filter is
+        applied in the current thread.
+
+    workspace : `DetectionWorkspace`, optional
+        Preallocated arrays, with the same shape as ``data``, to hold
+        the filtered, thresholded, and labeled images.  Reusing a
+        workspace avoids allocating these images when
+        `detect_sources` is called repeatedly on images of the same
+        shape.  The returned segmentation image is then
+        ``workspace.labels``, which is overwritten by the next call
+        using the same workspace.
+
+    bkgrd_stats_func : callable, optional
+        The function used to compute the image background statistics.
+        It is called as ``bkgrd_stats_func(data, image_mask=mask,
+        mask_val=mask_val, sig=sig, iters=iters)`` and must return the
+        sigma-clipped mean, median, and standard deviation.  The
+        default is ``imageutils.img_stats``.
+
     Returns
     -------
-    segment_image :  array_like
+    segment_image : `~numpy.ndarray` (int32)
         A 2D segmentation image of positive integers indicating labels
         for detected sources.  A value of zero is reserved for the
         background.
     """
 
-    from scipy import ndimage
-    bkgrd, median, bkgrd_rms = img_stats(data, image_mask=mask,
-                                         mask_val=mask_val, sig=sig,
-                                         iters=iters)
+    if bkgrd_stats_func is None:
+        bkgrd_stats_func = img_stats
+    bkgrd, median, bkgrd_rms = bkgrd_stats_func(data, image_mask=mask,
+                                                mask_val=mask_val, sig=sig,
+                                                iters=iters)
     assert npixels > 0, 'npixels must be a positive integer'
     assert int(npixels) == npixels, 'npixels must be a positive integer'
+    if engine not in ('auto', 'numba', 'sep'):
+        raise ValueError('{0} engine not supported'.format(engine))
+
+    if dtype is not None:
+        data = np.ascontiguousarray(data, dtype=dtype)
+    if filter_fwhm is not None and int(4.0 * filter_fwhm + 0.5) == 0:
+        filter_fwhm = None
+
+    if workspace is not None:
+        if workspace.shape != np.shape(data):
+            raise ValueError('workspace shape must match the data shape')
+        smooth = workspace.smooth
+        img_thresh = workspace.thresh
+        objlabels = workspace.labels
+    else:
+        smooth = None
+        img_thresh = np.empty(np.shape(data), dtype=np.uint8)
+        objlabels = np.empty(np.shape(data), dtype=np.int32)
+
+    if engine == 'sep':
+        try:
+            import sep
+        except ImportError:
+            engine = 'auto'
+        else:
+            segm = _extract_sep(data, bkgrd, bkgrd_rms, snr_threshold,
+                                npixels, filter_fwhm)
+            return _remove_small_objects(_label(segm), npixels,
+                                         output=objlabels)
 
     if filter_fwhm is not None:
-        img_smooth = ndimage.gaussian_filter(data, filter_fwhm)
+        img_smooth = _filter_image(data, filter_fwhm, method=filter_method,
+                                   n_jobs=n_jobs, output=smooth)
     else:
         img_smooth = data
 
-    # threshold the smoothed image
+    # threshold the smoothed image, with the level in the image dtype so
+    # that the comparison runs in that precision
+    img_smooth = np.asarray(img_smooth)
     level = bkgrd + (bkgrd_rms * snr_threshold)
-    img_thresh = img_smooth >= level
+    if img_smooth.dtype.kind == 'f':
+        level = img_smooth.dtype.type(level)
+
+    if engine == 'numba':
+        try:
+            from ._ccl_numba import _threshold_label, _finalize
+        except ImportError:
+            engine = 'auto'
+        else:
+            # numba only supports native byte order (e.g. FITS data are
+            # big-endian)
+            img_smooth = img_smooth.astype(
+                img_smooth.dtype.newbyteorder('='), copy=False)
+            parent, obj_npix = _threshold_label(img_smooth, level,
+                                                objlabels)
+            return _finalize(objlabels, parent, obj_npix, npixels)
+
+    np.greater_equal(img_smooth, level, out=img_thresh.view(np.bool_))
+
+    return _remove_small_objects(_label(img_thresh), npixels,
+                                 output=objlabels)
+
+
+def _img_stats_numba(data, image_mask=None, mask_val=None, sig=3.0,
+                    iters=None):
+    """
+    Compute the sigma-clipped mean, median, and standard deviation of
+    an image using `Numba <http://numba.pydata.org/>`_-compiled kernels.
+
+    This has the same interface as ``imageutils.img_stats`` (e.g. for
+    the ``bkgrd_stats_func`` keyword of `detect_sources`).  Values are
+    iteratively clipped around the median, and the mean and variance of
+    each iteration are computed in a single parallel pass.  Non-finite
+    values are ignored.
+
+    Parameters
+    ----------
+    data : array_like
+        The 2D array of the image.
+
+    image_mask : array_like, bool, optional
+        A boolean mask with the same shape as ``data``, where a `True`
+        value indicates the corresponding element of ``data`` is
+        invalid.  Masked pixels are ignored when computing the
+        statistics.
+
+    mask_val : float, optional
+        An image data value (e.g., ``0.0``) that is ignored when
+        computing the statistics.  ``mask_val`` will be ignored if
+        ``image_mask`` is input.
 
-    struct = ndimage.generate_binary_structure(2, 1)
-    objlabels, nobj = ndimage.label(img_thresh, structure=struct)
-    objslices = ndimage.find_objects(objlabels)
+    sig : float, optional
+        The number of standard deviations to use as the clipping limit.
 
-    # remove objects smaller than npixels size
-    for objslice in objslices:
-        objlabel = objlabels[objslice]
-        obj_npix = len(np.where(objlabel.ravel() != 0)[0])
-        if obj_npix < npixels:
-            objlabels[objslice] = 0
+    iters : int, optional
+       The number of iterations to perform clipping, or `None` to clip
+       until convergence is achieved (i.e. continue until the last
+       iteration clips nothing).
+
+    Returns
+    -------
+    mean, median, std : float
+        The mean, median, and standard deviation of the sigma-clipped
+        image.
+    """
+
+    from ._stats_numba import _sigma_clip_stats
+    data = np.asarray(data)
+    if image_mask is not None:
+        values = data[~np.asarray(image_mask, dtype=np.bool_)]
+    elif mask_val is not None:
+        values = data[data != mask_val]
+    else:
+        values = data.ravel()
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan, np.nan, np.nan
+    if iters is None:
+        iters = -1
+    return _sigma_clip_stats(values, float(sig), int(iters))
+
+
+class DetectionWorkspace(object):
+    """
+    Preallocated arrays for repeated calls to `detect_sources` on
+    images of the same shape.
+
+    A workspace must not be shared between threads calling
+    `detect_sources` concurrently; use one workspace per thread.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the images.
+
+    dtype : data-type, optional
+        The data type of the filtered image.  This should match the
+        ``dtype`` passed to `detect_sources`.
+
+    Attributes
+    ----------
+    smooth : `~numpy.ndarray`
+        The filtered image.
+
+    thresh : `~numpy.ndarray` (uint8)
+        The thresholded image.
+
+    labels : `~numpy.ndarray` (int32)
+        The segmentation image.
+    """
 
-    # relabel (labeled indices must be consecutive)
-    objlabels, nobj = ndimage.label(objlabels, structure=struct)
-    return objlabels
+    def __init__(self, shape, dtype=np.float32):
+        self.shape = tuple(shape)
+        self.smooth = np.empty(self.shape, dtype=dtype)
+        self.thresh = np.empty(self.shape, dtype=np.uint8)
+        self.labels = np.empty(self.shape, dtype=np.int32)
+
+
+def _remove_small_objects(objlabels, npixels, output=None):
+    """
+    Remove objects smaller than ``npixels`` from a segmentation image
+    and relabel it (labeled indices must be consecutive) with a single
+    lookup table, optionally placing the result in the int32 array
+    ``output``.
+    """
+
+    obj_npix = np.bincount(objlabels.ravel())
+    keep = obj_npix >= npixels
+    keep[0] = False
+    relabel = np.zeros(len(keep), dtype=np.int32)
+    relabel[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return np.take(relabel, objlabels, out=output, mode='clip')
+
+
+def _filter_image(data, filter_fwhm, method='auto', n_jobs=None,
+                  output=None):
+    """
+    Filter a 2D image with a circular 2D Gaussian kernel.
+
+    The ``'fft'`` method truncates the kernel at the same radius and
+    uses the same (reflected) boundary handling as
+    `scipy.ndimage.gaussian_filter`, which is used by the ``'direct'``
+    method, so both methods give the same result to within rounding
+    errors.
+
+    Parameters
+    ----------
+    data : array_like
+        The 2D array of the image.
+
+    filter_fwhm : float
+        The width of the Gaussian kernel.
+
+    method : {'auto', 'direct', 'fft'}, optional
+        The method used to apply the filter.  ``'auto'`` uses ``'fft'``
+        when ``filter_fwhm`` is larger than 4 pixels and ``'direct'``
+        otherwise.
+
+    n_jobs : int or `None`, optional
+        The number of threads used by the ``'direct'`` method.  See
+        `detect_sources`.
+
+    output : ndarray, optional
+        The array in which to place the output of the ``'direct'``
+        method.
+
+    Returns
+    -------
+    result : ndarray
+        The filtered image.
+    """
+
+    from scipy import ndimage
+    data = np.asarray(data)
+    if method == 'auto':
+        method = 'fft' if filter_fwhm > 4.0 else 'direct'
+
+    if method == 'direct':
+        if output is None:
+            output = np.empty(data.shape, dtype=data.dtype)
+        if n_jobs is not None and n_jobs != 1:
+            try:
+                import joblib
+            except ImportError:
+                n_jobs = None
+        if n_jobs is None or n_jobs == 1:
+            # filter the rows and then the columns, using the output
+            # array as the intermediate buffer
+            ndimage.gaussian_filter1d(data, filter_fwhm, axis=1,
+                                      output=output)
+            ndimage.gaussian_filter1d(output, filter_fwhm, axis=0,
+                                      output=output)
+        else:
+            _parallel_gaussian(data, filter_fwhm, n_jobs, output)
+        return output
+    elif method == 'fft':
+        from scipy import fft, signal
+        radius = int(4.0 * filter_fwhm + 0.5)
+        kernel = signal.windows.gaussian(2 * radius + 1, filter_fwhm)
+        kernel /= kernel.sum()
+        # convolve in float64: the FFT round-off scales with the image
+        # maximum, which in float32 can swamp the noise of faint pixels
+        padded = np.pad(data.astype(np.float64), radius, mode='symmetric')
+        with fft.set_workers(-1):
+            result = signal.fftconvolve(padded, np.outer(kernel, kernel),
+                                        mode='valid')
+        return result.astype(np.result_type(data.dtype, np.float32),
+                             copy=False)
+    else:
+        raise ValueError('{0} filter method not supported'.format(method))
+
+
+def _parallel_gaussian(data, sigma, n_jobs, output):
+    """
+    Filter a 2D image with a circular Gaussian kernel in parallel
+    threads.
+
+    The image is split into horizontal strips, one per job, that are
+    padded by the kernel radius and filtered independently, so the
+    result is identical to filtering the whole image at once.
+
+    Parameters
+    ----------
+    data : ndarray
+        The 2D array of the image.
+
+    sigma : float
+        The standard deviation of the Gaussian kernel.
+
+    n_jobs : int
+        The number of threads (``-1`` uses all CPUs).
+
+    output : ndarray
+        The array in which to place the output.
+    """
+
+    from joblib import Parallel, delayed, effective_n_jobs
+    from scipy import ndimage
+
+    radius = int(4.0 * sigma + 0.5)    # as in ndimage.gaussian_filter
+    ny = data.shape[0]
+    step = -(-ny // effective_n_jobs(n_jobs))
+
+    def filter_strip(y0, y1):
+        ylo = max(y0 - radius, 0)
+        yhi = min(y1 + radius, ny)
+        strip = ndimage.gaussian_filter1d(data[ylo:yhi], sigma, axis=1)
+        ndimage.gaussian_filter1d(strip, sigma, axis=0, output=strip)
+        output[y0:y1] = strip[y0 - ylo:y1 - ylo]
+
+    Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(filter_strip)(y0, min(y0 + step, ny))
+        for y0 in range(0, ny, step))
+    return output
+
+
+def _extract_sep(data, bkgrd, bkgrd_rms, snr_threshold, npixels,
+                 filter_fwhm):
+    """
+    Filter, threshold, and label an image in a single pass with
+    `sep.extract`.
+
+    `sep` labels 8-connected pixels and removes sources smaller than
+    ``npixels`` before returning the segmentation image, so its sources
+    are unions of the 4-connected sources found by `detect_sources`.
+    Relabeling the non-zero pixels with 4-connectivity and removing the
+    small sources again recovers the `detect_sources` segmentation.
+
+    Returns
+    -------
+    segment_image : ndarray
+        The 8-connected `sep` segmentation image.
+    """
+
+    import sep
+    if filter_fwhm is not None:
+        from astropy.convolution import Gaussian2DKernel
+        kernel = Gaussian2DKernel(filter_fwhm).array
+    else:
+        kernel = None
+
+    data = np.ascontiguousarray(data - bkgrd)
+    if data.dtype.kind != 'f':
+        data = data.astype(np.float64)
+    kwargs = dict(err=bkgrd_rms, minarea=npixels, filter_kernel=kernel,
+                  filter_type='conv', deblend_nthresh=1, deblend_cont=1.0,
+                  clean=False, segmentation_map=True)
+    try:
+        objects, segm = sep.extract(data, snr_threshold, **kwargs)
+    except Exception as exc:
+        if 'pixel buffer full' not in str(exc):
+            raise
+        # sep's pixel stack limit is process-wide, so raise it only for
+        # this call so that it can hold every pixel above threshold
+        pixstack = sep.get_extract_pixstack()
+        sep.set_extract_pixstack(data.size)
+        try:
+            objects, segm = sep.extract(data, snr_threshold, **kwargs)
+        finally:
+            sep.set_extract_pixstack(pixstack)
+    return segm
+
+
+def _get_struct():
+    """Return the cached 2D structuring element for 4-connectivity."""
+    global _STRUCT_2_1
+    if _STRUCT_2_1 is None:
+        from scipy import ndimage
+        _STRUCT_2_1 = ndimage.generate_binary_structure(2, 1)
+    return _STRUCT_2_1
+
+
+def _label(data):
+    """
+    Label the 4-connected regions of non-zero pixels in a 2D image.
+
+    The labeling is performed with `cc3d` if it is installed, otherwise
+    `scipy.ndimage.label` is used.
+
+    Parameters
+    ----------
+    data : array_like
+        The 2D image to label.
+
+    Returns
+    -------
+    labels : ndarray
+        A 2D image of consecutive positive integers labeling each
+        connected region.  A value of zero is reserved for the
+        background.
+    """
+
+    try:
+        import cc3d
+    except ImportError:
+        from scipy import ndimage
+        return ndimage.label(data, structure=_get_struct())[0]
+    return cc3d.connected_components(data, connectivity=4)
 
 
 def find_peaks(data, snr_threshold, min_distance=5, exclude_border=True,
                indices=True, num_peaks=np.inf, footprint=None, labels=None,
-               mask=None, mask_val=None, sig=3.0, iters=None):
+               mask=None, mask_val=None, sig=3.0, iters=None,
+               num_peaks_per_label=np.inf):
     """
     Find peaks in an image above above a specified signal-to-noise ratio
     threshold and return them as coordinates or a boolean array.
@@ -181,6 +603,15 @@ def find_peaks(data, snr_threshold, min_distance=5, exclude_border=True,
        iteration clips nothing) when calculating the image background
        statistics.
 
+    num_peaks_per_label : {1, `~numpy.inf`}, optional
+        The maximum number of peaks in each region of ``labels``.  If
+        1, only the maximum pixel of each region (excluding the border
+        if ``exclude_border=True``) is returned if it is above the
+        threshold, and the maxima of all the regions are found in a
+        single vectorized pass.  ``min_distance`` and ``footprint`` are
+        then ignored except for border exclusion.  Ignored if
+        ``labels`` is `None`.
+
     Returns
     -------
     output : ndarray or ndarray of bools
@@ -198,15 +629,184 @@ def find_peaks(data, snr_threshold, min_distance=5, exclude_border=True,
     comparison between dilated and original image, peak_local_max
     function returns the coordinates of peaks where dilated image =
     original.
+
+    If neither ``footprint`` nor ``labels`` is input, the image is
+    dilated with ``cv2.dilate`` if `OpenCV <http://opencv.org/>`_
+    (``cv2``) is installed, which is much faster than the maximum
+    filter used by `skimage.feature.peak_local_max`, or otherwise
+    directly with `scipy.ndimage.maximum_filter`.
     """
-    from skimage.feature import peak_local_max
 
     bkgrd, median, bkgrd_rms = img_stats(data, image_mask=mask,
                                          mask_val=mask_val, sig=sig,
                                          iters=iters)
     level = bkgrd + (bkgrd_rms * snr_threshold)
-    return peak_local_max(data, min_distance=min_distance,
-                          threshold_abs=level, threshold_rel=0.0,
-                          exclude_border=exclude_border, indices=indices,
-                          num_peaks=num_peaks, footprint=footprint,
-                          labels=labels)
+    # peak_local_max (with threshold_rel=0) never thresholds below zero
+    level = max(level, 0.)
+
+    if labels is not None and num_peaks_per_label != np.inf:
+        if num_peaks_per_label != 1:
+            raise ValueError('num_peaks_per_label must be 1 or np.inf')
+        return _label_max_peaks(np.asarray(data), np.asarray(labels), level,
+                                min_distance, exclude_border, indices,
+                                num_peaks)
+
+    if footprint is None and labels is None:
+        data = np.asarray(data)
+        if data.dtype != np.float32:
+            data = data.astype(np.float64)
+        data_max = _maximum_filter(data, min_distance)
+        return _local_max_peaks(data, data_max, level, min_distance,
+                                exclude_border, indices, num_peaks)
+
+    # the indices keyword was removed from peak_local_max in
+    # scikit-image 0.20, but coordinates are returned by default
+    from skimage.feature import peak_local_max
+    coords = peak_local_max(data, min_distance=min_distance,
+                            threshold_abs=level, threshold_rel=0.0,
+                            exclude_border=exclude_border,
+                            num_peaks=num_peaks, footprint=footprint,
+                            labels=labels)
+    if indices:
+        return coords
+    peaks = np.zeros(np.shape(data), dtype=np.bool_)
+    peaks[tuple(np.transpose(coords))] = True
+    return peaks
+
+
+def _maximum_filter(data, min_distance):
+    """
+    Maximum filter a 2D image with a square window of size ``2 *
+    min_distance + 1``, assuming zeros beyond the image boundary.
+
+    ``cv2.dilate`` is used if OpenCV is installed, otherwise
+    `scipy.ndimage.maximum_filter`.
+    """
+
+    size = 2 * min_distance + 1
+    try:
+        import cv2
+    except ImportError:
+        from scipy import ndimage
+        return ndimage.maximum_filter(data, size=size, mode='constant')
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (size, size))
+    return cv2.dilate(data, kernel, borderType=cv2.BORDER_CONSTANT,
+                      borderValue=0)
+
+
+def _local_max_peaks(data, data_max, level, min_distance, exclude_border,
+                     indices, num_peaks):
+    """
+    Find the peaks in an image given its maximum-filtered (dilated)
+    image.
+
+    This reproduces the selection performed by
+    `skimage.feature.peak_local_max` after its maximum filter, so that
+    `find_peaks` returns the same peaks regardless of how ``data_max``
+    was computed.
+
+    Parameters
+    ----------
+    data : ndarray
+        The 2D array of the image.
+
+    data_max : ndarray
+        The maximum-filtered ``data``, using a square window of size ``2
+        * min_distance + 1`` and zeros beyond the image boundary.
+
+    level : float
+        The threshold above which peaks are detected, which must not be
+        negative (as for `skimage.feature.peak_local_max`).
+
+    min_distance, exclude_border, indices, num_peaks
+        See `find_peaks`.
+
+    Returns
+    -------
+    output : ndarray or ndarray of bools
+        See `find_peaks`.
+    """
+
+    if np.all(data == data.flat[0]):
+        peaks = np.zeros(data.shape, dtype=np.bool_)
+    else:
+        peaks = (data == data_max) & (data > level)
+        if exclude_border:
+            _zero_border(peaks, min_distance)
+    return _select_peaks(data, peaks, indices, num_peaks)
+
+
+def _label_max_peaks(data, labels, level, min_distance, exclude_border,
+                     indices, num_peaks):
+    """
+    Find the maximum pixel of each labeled region in an image.
+
+    The maxima of all the regions are found in a single call to
+    `scipy.ndimage.maximum_position`.  If a region has several pixels
+    with the maximum value, only the first one (in raster order) is
+    returned.
+
+    Parameters
+    ----------
+    data : ndarray
+        The 2D array of the image.
+
+    labels : ndarray of ints
+        The 2D segmentation image.  Zero is reserved for background.
+
+    level : float
+        The threshold above which peaks are detected, which must not be
+        negative (as for `skimage.feature.peak_local_max`).
+
+    min_distance, exclude_border, indices, num_peaks
+        See `find_peaks`.
+
+    Returns
+    -------
+    output : ndarray or ndarray of bools
+        See `find_peaks`.
+    """
+
+    from scipy import ndimage
+    if exclude_border:
+        labels = labels.copy()
+        _zero_border(labels, min_distance)
+    index = np.nonzero(np.bincount(labels.ravel()))[0]
+    index = index[index != 0]
+
+    peaks = np.zeros(data.shape, dtype=np.bool_)
+    if len(index) > 0:
+        coords = np.array(ndimage.maximum_position(data, labels, index))
+        coords = coords[data[tuple(coords.T)] > level]
+        peaks[tuple(coords.T)] = True
+    return _select_peaks(data, peaks, indices, num_peaks)
+
+
+def _zero_border(data, width):
+    """Set a border of ``width`` pixels of a 2D array to zero in place."""
+    if width > 0:
+        data[:width] = 0
+        data[-width:] = 0
+        data[:, :width] = 0
+        data[:, -width:] = 0
+
+
+def _select_peaks(data, peaks, indices, num_peaks):
+    """
+    Keep the ``num_peaks`` brightest peaks and return them in the
+    format requested by ``indices`` (see `find_peaks`).
+    """
+
+    coords = np.argwhere(peaks)
+    if len(coords) > num_peaks:
+        idx_maxsort = np.argsort(data[peaks])[::-1]
+        coords = coords[idx_maxsort][:num_peaks]
+        if not indices:
+            peaks = np.zeros(data.shape, dtype=np.bool_)
+            peaks[tuple(coords.T)] = True
+
+    if indices:
+        return coords
+    else:
+        return peaks
@@ -3,8 +3,10 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from astropy.tests.helper import pytest
 import numpy as np
-from numpy.testing import assert_array_equal
-from ..core import detect_sources, find_peaks
+from numpy.testing import assert_allclose, assert_array_equal
+from imageutils import img_stats
+from ..core import (DetectionWorkspace, detect_sources, find_peaks,
+                    _img_stats_numba)
 
 try:
     import scipy
@@ -18,15 +20,51 @@ try:
 except ImportError:
     HAS_SKIMAGE = False
 
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+try:
+    import joblib
+    HAS_JOBLIB = True
+except ImportError:
+    HAS_JOBLIB = False
+
+try:
+    import sep
+    HAS_SEP = True
+except ImportError:
+    HAS_SEP = False
+
+try:
+    import cv2
+    HAS_CV2 = True
+except ImportError:
+    HAS_CV2 = False
+
 
 DATA = np.array([[0, 1, 0], [0, 2, 0], [0, 0, 0]]).astype(np.float)
 REF1 = np.array([[0, 0, 0], [0, 0, 0], [0, 0, 0]])
 REF2 = np.array([[0, 1, 0], [0, 1, 0], [0, 0, 0]])
 REF3 = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]])
 
+DATA2 = np.array([[1, 1, 1, 0], [0, 0, 1, 0], [1, 0, 1, 0],
+                  [1, 1, 0, 0]]).astype(np.float)
+REF4 = np.array([[1, 1, 1, 0], [0, 0, 1, 0], [0, 0, 1, 0], [0, 0, 0, 0]])
+
+DATA3 = np.array([[1, 1, 0, 1, 0, 1, 1], [0, 0, 0, 0, 0, 0, 0],
+                  [0, 0, 0, 0, 0, 0, 0]]).astype(np.float)
+REF5 = np.array([[1, 1, 0, 0, 0, 2, 2], [0, 0, 0, 0, 0, 0, 0],
+                 [0, 0, 0, 0, 0, 0, 0]])
+
+NOISE = np.random.RandomState(0).normal(size=(50, 60))
+
 PEAKDATA = np.array([[1, 0, 0], [0, 0, 0], [0, 0, 1]]).astype(np.float)
 PEAKREF1 = np.array([[0, 0], [2, 2]])
 PEAKREF2 = np.array([]).reshape(0, 2)
+PEAKLABELS = np.array([[1, 1, 0], [0, 0, 0], [0, 2, 2]])
 
 
 @pytest.mark.skipif('not HAS_SCIPY')
@@ -36,11 +74,31 @@ class TestDetectSources(object):
         segm = detect_sources(DATA, 0.1, 2)
         assert_array_equal(segm, REF2)
 
+    def test_dtype_int32(self):
+        """Test that the segmentation image is int32."""
+        segm = detect_sources(DATA, 0.1, 2)
+        assert segm.dtype == np.int32
+
     def test_small_sources(self):
         """Test detection where sources are smaller than npixels size."""
         segm = detect_sources(DATA, 0.1, 5)
         assert_array_equal(segm, REF1)
 
+    def test_npixels_overlap(self):
+        """
+        Test that pixels of other sources within the bounding box of a
+        source are not counted towards its size.
+        """
+        segm = detect_sources(DATA2, 0.1, 6)
+        assert_array_equal(segm, np.zeros_like(REF4))
+        segm = detect_sources(DATA2, 0.1, 5)
+        assert_array_equal(segm, REF4)
+
+    def test_consecutive_labels(self):
+        """Test that labels are consecutive after removing sources."""
+        segm = detect_sources(DATA3, 0.1, 2)
+        assert_array_equal(segm, REF5)
+
     def test_zerothresh(self):
         """Test detection with zero snr_threshold."""
         segm = detect_sources(DATA, 0.0, 2)
@@ -61,6 +119,102 @@ class TestDetectSources(object):
         segm = detect_sources(DATA, 1, 1, filter_fwhm=0.5)
         assert_array_equal(segm, REF3)
 
+    def test_dtype(self):
+        """Test detection without converting the image data type."""
+        segm = detect_sources(DATA, 0.1, 2, filter_fwhm=1., dtype=None)
+        assert_array_equal(segm, REF2)
+
+    def test_filter_tiny(self):
+        """Test that a tiny filter_fwhm skips filtering."""
+        segm1 = detect_sources(DATA, 0.1, 1, filter_fwhm=0.1)
+        segm2 = detect_sources(DATA, 0.1, 1)
+        assert_array_equal(segm1, segm2)
+
+    def test_filter_method(self):
+        """Test that the direct and FFT filter methods agree."""
+        segm1 = detect_sources(NOISE, 1., 2, filter_fwhm=5.,
+                               filter_method='direct')
+        segm2 = detect_sources(NOISE, 1., 2, filter_fwhm=5.,
+                               filter_method='fft')
+        assert_array_equal(segm1, segm2)
+
+    def test_filter_method_bright(self):
+        """
+        Test that the FFT filter does not add noise that scales with the
+        brightest source of a float32 image.
+        """
+        data = NOISE.copy()
+        data[20:25, 30:35] = 1.e6
+        segm1 = detect_sources(data, 0.05, 2, filter_fwhm=5.,
+                               filter_method='direct')
+        segm2 = detect_sources(data, 0.05, 2, filter_fwhm=5.,
+                               filter_method='fft')
+        assert_array_equal(segm1, segm2)
+
+    @pytest.mark.skipif('not HAS_JOBLIB')
+    def test_n_jobs(self):
+        """Test that filtering in parallel strips gives the same result."""
+        segm1 = detect_sources(NOISE, 1., 2, filter_fwhm=2.)
+        segm2 = detect_sources(NOISE, 1., 2, filter_fwhm=2., n_jobs=3)
+        assert_array_equal(segm1, segm2)
+
+    def test_filter_method_error(self):
+        """Test if ValueError raises if filter_method is invalid."""
+        with pytest.raises(ValueError):
+            detect_sources(DATA, 0.1, 2, filter_fwhm=1.,
+                           filter_method='invalid')
+
+    @pytest.mark.skipif('not HAS_NUMBA')
+    def test_numba_engine(self):
+        """Test that the numba engine gives the same segmentation."""
+        segm1 = detect_sources(NOISE, 1., 3)
+        segm2 = detect_sources(NOISE, 1., 3, engine='numba')
+        assert_array_equal(segm1, segm2)
+        segm3 = detect_sources(NOISE.astype('>f8'), 1., 3, engine='numba',
+                               dtype=None)
+        assert_array_equal(segm1, segm3)
+
+    @pytest.mark.skipif('not HAS_SEP')
+    def test_sep_engine(self):
+        """Test that the sep engine gives the same segmentation."""
+        segm1 = detect_sources(NOISE, 1., 3)
+        segm2 = detect_sources(NOISE, 1., 3, engine='sep')
+        assert_array_equal(segm1, segm2)
+
+    @pytest.mark.skipif('not HAS_SEP')
+    def test_sep_engine_filter(self):
+        """
+        Test that the sep engine gives the same sources away from the
+        image edges when filtering.
+        """
+        segm1 = detect_sources(NOISE, 0.2, 3, filter_fwhm=1.)
+        segm2 = detect_sources(NOISE, 0.2, 3, filter_fwhm=1., engine='sep')
+        assert_array_equal(segm1[5:-5, 5:-5] > 0, segm2[5:-5, 5:-5] > 0)
+
+    def test_engine_error(self):
+        """Test if ValueError raises if engine is invalid."""
+        with pytest.raises(ValueError):
+            detect_sources(DATA, 0.1, 2, engine='invalid')
+
+    def test_workspace(self):
+        """Test detection with a preallocated workspace."""
+        workspace = DetectionWorkspace(DATA.shape)
+        segm = detect_sources(DATA, 0.1, 2, filter_fwhm=1.,
+                              workspace=workspace)
+        assert_array_equal(segm, REF2)
+        assert segm is workspace.labels
+
+    def test_workspace_shape_error(self):
+        """Test if ValueError raises if the workspace shape is wrong."""
+        with pytest.raises(ValueError):
+            detect_sources(DATA, 0.1, 2, workspace=DetectionWorkspace((2, 2)))
+
+    @pytest.mark.skipif('not HAS_NUMBA')
+    def test_bkgrd_stats_func(self):
+        """Test detection with the numba background statistics."""
+        segm = detect_sources(DATA, 0.1, 2, bkgrd_stats_func=_img_stats_numba)
+        assert_array_equal(segm, REF2)
+
     def test_npix1_error(self):
         """Test if AssertionError raises if npixel is non-integer."""
         with pytest.raises(AssertionError):
@@ -94,6 +248,41 @@ class TestDetectSources(object):
         assert_array_equal(segm, REF2)
 
 
+@pytest.mark.skipif('not HAS_NUMBA')
+class TestImgStatsNumba(object):
+    def setup_class(self):
+        self.data = NOISE.copy()
+        self.data[10, 10:20] = 100.
+
+    def test_img_stats(self):
+        """Test that the statistics match imageutils.img_stats."""
+        assert_allclose(_img_stats_numba(self.data), img_stats(self.data))
+
+    def test_iters(self):
+        """Test a fixed number of clipping iterations."""
+        assert_allclose(_img_stats_numba(self.data, sig=2., iters=2),
+                        img_stats(self.data, sig=2., iters=2))
+
+    def test_mask(self):
+        """Test that masked pixels are ignored."""
+        mask = self.data > 50.
+        assert_allclose(_img_stats_numba(self.data, image_mask=mask),
+                        img_stats(self.data, image_mask=mask))
+
+    def test_nan(self):
+        """Test that NaN values are ignored."""
+        data = self.data.copy()
+        data[0, 0] = np.nan
+        mask = ~np.isfinite(data)
+        assert_allclose(_img_stats_numba(data),
+                        img_stats(data, image_mask=mask))
+
+    def test_all_nan(self):
+        """Test that NaN statistics are returned for an all-NaN image."""
+        data = np.zeros((3, 3)) * np.nan
+        assert np.all(np.isnan(_img_stats_numba(data)))
+
+
 @pytest.mark.skipif('not HAS_SCIPY')
 @pytest.mark.skipif('not HAS_SKIMAGE')
 class TestFindPeaks(object):
@@ -111,3 +300,36 @@ class TestFindPeaks(object):
         """Test with large snr_threshold giving no sources."""
         segm = find_peaks(PEAKDATA, 0., min_distance=1, exclude_border=True)
         assert_array_equal(segm, PEAKREF2)
+
+    @pytest.mark.skipif('not HAS_CV2')
+    def test_cv2(self):
+        """Test that the OpenCV dilation gives the same peaks."""
+        footprint = np.ones((5, 5), dtype=np.bool)
+        peaks1 = find_peaks(NOISE, 1., min_distance=2, indices=False)
+        peaks2 = find_peaks(NOISE, 1., min_distance=2, indices=False,
+                            footprint=footprint)
+        assert_array_equal(peaks1, peaks2)
+
+    def test_negative_threshold(self):
+        """
+        Test that, as for skimage.feature.peak_local_max, peaks are not
+        detected below zero.
+        """
+        footprint = np.ones((5, 5), dtype=np.bool)
+        peaks1 = find_peaks(NOISE - 5., 1., min_distance=2)
+        peaks2 = find_peaks(NOISE - 5., 1., min_distance=2,
+                            footprint=footprint)
+        assert_array_equal(peaks1, PEAKREF2)
+        assert_array_equal(peaks2, PEAKREF2)
+
+    def test_num_peaks_per_label(self):
+        """Test finding the maximum of each labeled region."""
+        segm = find_peaks(PEAKDATA, 0., min_distance=1, exclude_border=False,
+                          labels=PEAKLABELS, num_peaks_per_label=1)
+        assert_array_equal(segm, PEAKREF1)
+
+    def test_num_peaks_per_label_error(self):
+        """Test if ValueError raises if num_peaks_per_label is invalid."""
+        with pytest.raises(ValueError):
+            find_peaks(PEAKDATA, 0., labels=PEAKLABELS,
+                       num_peaks_per_label=2)